@@ -1,32 +1,65 @@
+import html
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix
-from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import coo_matrix
 from flask import Flask, render_template_string, request, jsonify
 
+# SimSIMD がインストールされていれば、SIMD 版のコサイン距離計算を使う
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+# CuPy がインストールされていれば、大きなカタログでは GPU で類似度を計算する
+try:
+    import cupy
+    import cupyx.scipy.sparse
+except ImportError:
+    cupy = None
+
 # --- データ読み込みとモデル学習 ---
 
 # 映画の評価データを読み込み
-df_ratings = pd.read_csv("./ratings_100k.csv", sep=",")
-df_ratings = df_ratings.iloc[:,0:3]
+# 必要な3列だけを型を指定して読み込む (型推論と不要な列のパースを省く)
+df_ratings = pd.read_csv(
+    "./ratings_100k.csv",
+    sep=",",
+    usecols=['userId', 'movieId', 'rating'],
+    dtype={'userId': np.int32, 'movieId': np.int32, 'rating': np.float32},
+    engine="c",
+)
 
 # df_ratingsのカラム名を変更: 'movieId' -> 'movie_id'
 df_ratings = df_ratings.rename(columns={'movieId': 'movie_id'})
 
 # 映画のデータを読み込み
 # 💡 修正点 1: skipinitialspace=Trueを追加 (区切り文字の前後の空白を無視)
-# 💡 修正点 2: ファイルにヘッダーデータが紛れ込んでいる可能性を考慮し、header=Noneを維持しつつ、
-#             データ型を正しく推測できるようにします。
+# 💡 修正点 2: 1行目はヘッダーなので header=0 で読み飛ばし、movie_id と movie_title の2列だけを
+#             読み込みます (残りの列はパースしない)。movie_id は不正な値が混ざっていても
+#             読み込みで止まらないよう型を指定せず、下の修正点 3 で数値に変換します。
 df_movies = pd.read_csv(
     "./movies_100k.csv", 
     sep="|", 
-    header=None, 
+    header=0, 
     encoding="latin-1",
-    names=['movie_id', 'movie_title', 'release_date', 'video_release_date', 'imdb_url'] + [f'genre_{i}' for i in range(19)],
+    usecols=[0, 1],
+    names=['movie_id', 'movie_title'],
+    engine="c",
     # skipinitialspace=True # 今回はセパレータが'|'なので不要だが、念のため。
 )
-# movie_idとmovie_titleのみを抽出
-df_movies = df_movies[['movie_id', 'movie_title']]
-df_movies['movie_title_clean'] = df_movies['movie_title'].str.replace(r' \(\d{4}\)', '', regex=True)
+
+# タイトルから公開年 " (YYYY)" を取り除く (正規表現は一度だけコンパイルする)
+# 末尾に空白や "(V)" が続くタイトルもあるため、末尾には固定しない
+_YEAR = re.compile(r' \(\d{4}\)')
+df_movies['movie_title_clean'] = df_movies['movie_title'].map(
+    lambda title: _YEAR.sub('', title) if isinstance(title, str) else title
+)
 
 # 💡 修正点 3: データ型変換時にエラーを無視し、変換できなかった値をNaN (欠損値) にする
 #             その後、欠損値を0で埋めてint型に変換することで、不正なデータ行を処理から除外する
@@ -43,104 +76,208 @@ except ValueError as e:
     print(f"型変換エラー: {e}")
     # プログラムを終了せず続行するため、ここでは pass
 
+# movie_id -> タイトル の辞書 (タイトル解決のたびに DataFrame を走査しないため)
+TITLE_MAP = dict(zip(df_movies['movie_id'].to_numpy(), df_movies['movie_title'].to_numpy()))
+
 # 評価データと映画データを 'movie_id' でマージ
 df_merged = pd.merge(df_ratings, df_movies, on='movie_id')
 
-# ユーザー×映画のピボットテーブルを作成 (モデル学習用)
-df_piv = df_merged.pivot(index="movie_id", columns="userId", values="rating").fillna(0) 
+# 映画×ユーザーの評価値を (行, 列, 値) の組から直接疎行列にする (モデル学習用)
+# 密なピボットテーブルを経由しないため、0 で埋めた行列を確保せずに済む
+movie_cat = pd.Categorical(df_merged['movie_id'])
+user_cat = pd.Categorical(df_merged['userId'])
 
-# 疎行列に変換
-df_sp = csr_matrix(df_piv.values)
+# 疎行列に変換 (float32 にしてメモリ帯域を半分にする)
+df_sp = coo_matrix(
+    (df_merged['rating'].to_numpy(dtype=np.float32), (movie_cat.codes, user_cat.codes)),
+    shape=(len(movie_cat.categories), len(user_cat.categories)),
+).tocsr()
 
-# 類似度計算モデルを作成
-rec = NearestNeighbors(n_neighbors=11, algorithm="brute", metric="cosine")
-rec_model = rec.fit(df_sp)
+# 評価数の多い映画が隣り合うように行を並べ替える (類似度計算時のキャッシュ効率を上げるため)
+_row_order = np.argsort(-np.diff(df_sp.indptr), kind='stable')
+df_sp = df_sp[_row_order]
 
-# --- (以下、関数定義 get_recommendations, get_top_rated_movies, Flaskルート関数は変更なし) ---
-# ※ 長くなるため省略しますが、前回お送りしたコードの続きをご使用ください。
+# movie_id -> 行番号 の辞書と、行番号 -> movie_id の配列を事前に作成
+IDX_ARRAY = np.asarray(movie_cat.categories)[_row_order]
+IDX_MAP = dict(zip(IDX_ARRAY.tolist(), range(len(IDX_ARRAY))))
 
-def get_recommendations(movie_ids):
-    # ... (前回のコードの内容をそのまま使用) ...
-    recommendations = {}
-    
-    for movie_id in movie_ids:
+# 各行の L2 ノルムを一度だけ計算し、正規化した行を保持する (コサイン類似度が内積だけで求まる)
+ROW_NORMS = np.sqrt(np.asarray(df_sp.multiply(df_sp).sum(axis=1)).ravel())
+ROW_NORMS[ROW_NORMS == 0] = 1
+M_norm = df_sp.multiply(1 / ROW_NORMS[:, None]).tocsr()
+M_norm_T = M_norm.T.tocsr()
+
+# GPU を使うのは映画数がこの値以上のときだけ
+# 20000 本は計測していない目安の値 (100k 版の約1700本では GPU は使わない)
+GPU_MIN_MOVIES = 20000
+USE_GPU = cupy is not None and df_sp.shape[0] >= GPU_MIN_MOVIES
+
+# CUDA のコンテキストは fork を越えて使えないため、GPU 上の行列は import 時ではなく
+# 各ワーカープロセスで最初に使うときに作る (gunicorn --preload 対策)
+_gpu_matrices = None
+_gpu_lock = threading.Lock()
+
+
+def _sparse_dist(query_rows):
+    # 疎行列同士の積なので、非ゼロ要素が重なる部分だけが計算される
+    return 1 - (M_norm[query_rows] @ M_norm_T).toarray()
+
+
+def _simsimd_dist(query_rows):
+    return np.array(simsimd.cdist(D[query_rows], D, metric="cosine"), dtype=np.float32)
+
+
+def _gpu_dist(query_rows):
+    global _gpu_matrices
+    if _gpu_matrices is None:
+        with _gpu_lock:
+            if _gpu_matrices is None:
+                _gpu_matrices = (
+                    cupyx.scipy.sparse.csr_matrix(M_norm),
+                    cupyx.scipy.sparse.csr_matrix(M_norm_T),
+                )
+    m_gpu, m_t_gpu = _gpu_matrices
+    # 類似度は GPU 上で計算し、上位 K 件の選択は CPU に戻してから行う
+    sims = (m_gpu[cupy.asarray(query_rows)] @ m_t_gpu).toarray()
+    return (1 - sims).get()
+
+
+def _time_per_query(dist_fn, query_rows, repeat=20):
+    """dist_fn の1回あたりの実行時間 (秒) を測る"""
+    dist_fn(query_rows)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        dist_fn(query_rows)
+    return (time.perf_counter() - start) / repeat
+
+
+# 近傍探索の実装は起動時に1つだけ決める
+# CPU では疎行列の積を標準とし、SimSIMD は起動時の計測で疎行列の積より速かった場合だけ使う
+D = None
+if USE_GPU:
+    NEIGHBOR_BACKEND = "gpu"
+else:
+    NEIGHBOR_BACKEND = "sparse"
+    if simsimd is not None:
+        # SimSIMD 用の密行列 (評価値は小さな整数なので float16 で十分)。計測で負けたら捨てる
+        D = df_sp.toarray().astype(np.float16)
+        n_movies = df_sp.shape[0]
+        sample_rows = [0, n_movies // 2, n_movies - 1]
+        if _time_per_query(_simsimd_dist, sample_rows) < _time_per_query(_sparse_dist, sample_rows):
+            NEIGHBOR_BACKEND = "simsimd"
+        else:
+            D = None
+
+
+def find_neighbors(query_rows, n_neighbors=10):
+    """query_rows の各行について、自分自身を除きコサイン距離が近い順に (距離, 行番号) を返す"""
+    global NEIGHBOR_BACKEND
+    if NEIGHBOR_BACKEND == "gpu":
         try:
-            movie_idx = df_piv.index.get_loc(movie_id)
-            
-            distance, indice = rec_model.kneighbors(df_sp[movie_idx], n_neighbors=11)
-            
-            similar_movie_indices = indice.flatten()
-            similar_movie_ids = [df_piv.index[i] for i in similar_movie_indices]
-            
-            scores = 1 - distance.flatten()
-            
-            for i in range(1, len(similar_movie_ids)): 
-                rec_id = similar_movie_ids[i]
-                rec_score = scores[i]
-                recommendations[rec_id] = recommendations.get(rec_id, 0) + rec_score
-        
-        except KeyError:
+            dist = _gpu_dist(query_rows)
+        except (cupy.cuda.runtime.CUDARuntimeError, cupy.cuda.driver.CUDADriverError) as e:
+            # CuPy はあっても使える GPU がない場合は、このプロセスでは以後 CPU で計算する
+            print(f"GPU が使えないため CPU で計算します: {e}")
+            NEIGHBOR_BACKEND = "sparse"
+            dist = _sparse_dist(query_rows)
+    elif NEIGHBOR_BACKEND == "simsimd":
+        dist = _simsimd_dist(query_rows)
+    else:
+        dist = _sparse_dist(query_rows)
+
+    # 自分自身の行は位置ではなく行番号で除外する (類似度 1 で並ぶ別の映画があっても取り違えない)
+    dist[np.arange(len(query_rows)), query_rows] = np.inf
+
+    # 全件をソートせず上位 K 件だけを部分選択し、その中だけを距離順に並べる
+    part = np.argpartition(dist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+    part_dist = np.take_along_axis(dist, part, axis=1)
+    order = np.argsort(part_dist, axis=1)
+    return np.take_along_axis(part_dist, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+# --- 推薦処理 (get_recommendations, get_top_rated_movies) ---
+
+@lru_cache(maxsize=4096)
+def _cached_recommendations(movie_ids):
+    # 評価データに存在しない映画は例外を使わずに読み飛ばす
+    query_rows = []
+    for movie_id in movie_ids:
+        movie_idx = IDX_MAP.get(movie_id)
+        if movie_idx is None:
             continue
+        query_rows.append(movie_idx)
+
+    if not query_rows:
+        return ()
+
+    # 選択された映画の行をまとめて1回の呼び出しで近傍を求める
+    distances, indices = find_neighbors(query_rows, n_neighbors=10)
+
+    # 類似度を映画ごとに合算する
+    score_accum = np.bincount(
+        indices.ravel(),
+        weights=(1 - distances).ravel(),
+        minlength=len(IDX_ARRAY),
+    ).astype(np.float32)
+
+    # 選択済みの映画は推薦対象から外す
+    score_accum[query_rows] = 0
+
+    # 上位5件だけを部分選択し、その5件だけをスコア順に並べる
+    top_rows = np.argpartition(-score_accum, 5)[:5]
+    top_rows = top_rows[np.argsort(-score_accum[top_rows], kind='stable')]
+    top_rows = top_rows[score_accum[top_rows] > 0]
+    final_recs = IDX_ARRAY[top_rows].tolist()
+
+    rec_titles = tuple(TITLE_MAP[mid] for mid in final_recs if mid in TITLE_MAP)
 
-    sorted_recs = sorted(recommendations.items(), key=lambda item: item[1], reverse=True)
-    
-    final_recs = []
-    for rec_id, _ in sorted_recs:
-        if rec_id not in movie_ids:
-            final_recs.append(rec_id)
-        if len(final_recs) >= 5:
-            break
-            
-    rec_titles = []
-    for movie_id in final_recs:
-        title_series = df_movies[df_movies['movie_id'] == movie_id]['movie_title']
-        if not title_series.empty:
-             rec_titles.append(title_series.iloc[0])
-        
     return rec_titles
 
+
+def get_recommendations(movie_ids):
+    # 同じ映画の組み合わせなら結果も同じなので、並び順をそろえたタプルをキーにキャッシュする
+    return list(_cached_recommendations(tuple(sorted(set(movie_ids)))))
+
 def get_top_rated_movies():
-    df_mean_rating = df_merged.groupby('movie_id')['rating'].mean().reset_index()
+    # 平均評価値と評価数を1回の groupby でまとめて求める
+    counts = df_merged.groupby('movie_id')['rating'].agg(['mean', 'count'])
+    min_ratings_threshold = counts['count'].median()
+    popular = counts[counts['count'].to_numpy() >= min_ratings_threshold]
 
-    df_count_rating = df_merged.groupby('movie_id')['rating'].count().reset_index()
-    min_ratings_threshold = df_count_rating['rating'].median()
-    popular_movies = df_count_rating[df_count_rating['rating'] >= min_ratings_threshold]['movie_id']
-    df_mean_rating = df_mean_rating[df_mean_rating['movie_id'].isin(popular_movies)]
+    top_5_ids = popular.sort_values(by='mean', ascending=False).head(5).index.tolist()
 
-    top_5_ids = df_mean_rating.sort_values(by='rating', ascending=False).head(5)['movie_id'].tolist()
+    top_5_titles = [TITLE_MAP[mid] for mid in top_5_ids if mid in TITLE_MAP]
 
-    top_5_titles = []
-    for movie_id in top_5_ids:
-        title_series = df_movies[df_movies['movie_id'] == movie_id]['movie_title']
-        if not title_series.empty:
-             top_5_titles.append(title_series.iloc[0])
-        
     return top_5_titles
 
 
+# 評価値の高い映画トップ5はデータが変わらない限り同じなので、起動時に一度だけ計算する
+TOP_RATED_TITLES = get_top_rated_movies()
+
+
 app = Flask(__name__)
 
 movie_list = df_movies[['movie_id', 'movie_title']].sort_values(by='movie_title').values.tolist()
 
 
-@app.route('/')
-def index():
-    return f"""
+# 映画の選択肢と画面の HTML は変わらないので、起動時に一度だけ組み立てる
+OPTIONS_HTML = "".join(f'<option value="{mid}">{html.escape(title)}</option>' for mid, title in movie_list)
+
+INDEX_HTML = """
 <!DOCTYPE html>
 <html lang="ja">
 <head>
     <meta charset="UTF-8">
     <title>映画推薦システム</title>
     <style>
-        body {{ font-family: sans-serif; padding: 20px; }}
-        .container {{ max-width: 600px; margin: auto; border: 1px solid #ccc; padding: 30px; border-radius: 8px; }}
-        h2 {{ color: #333; }}
-        select, button {{ padding: 10px; margin: 10px 0; width: 100%; box-sizing: border-box; }}
-        button {{ background-color: #007bff; color: white; border: none; cursor: pointer; }}
-        button:hover {{ background-color: #0056b3; }}
-        .recommendation-list {{ margin-top: 20px; }}
-        .recommendation-list ol {{ padding-left: 20px; }}
-        .recommendation-list li {{ margin-bottom: 5px; }}
+        body { font-family: sans-serif; padding: 20px; }
+        .container { max-width: 600px; margin: auto; border: 1px solid #ccc; padding: 30px; border-radius: 8px; }
+        h2 { color: #333; }
+        select, button { padding: 10px; margin: 10px 0; width: 100%; box-sizing: border-box; }
+        button { background-color: #007bff; color: white; border: none; cursor: pointer; }
+        button:hover { background-color: #0056b3; }
+        .recommendation-list { margin-top: 20px; }
+        .recommendation-list ol { padding-left: 20px; }
+        .recommendation-list li { margin-bottom: 5px; }
     </style>
 </head>
 <body>
@@ -152,7 +289,7 @@ def index():
                 <label for="movie1">1つ目の映画:</label>
                 <select name="movie1" id="movie1">
                     <option value="">-- 映画を選択してください --</option>
-                    {"".join([f'<option value="{mid}">{title}</option>' for mid, title in movie_list])}
+                    {{OPTIONS}}
                 </select>
             </div>
 
@@ -160,7 +297,7 @@ def index():
                 <label for="movie2">2つ目の映画:</label>
                 <select name="movie2" id="movie2">
                     <option value="">-- 映画を選択してください --</option>
-                    {"".join([f'<option value="{mid}">{title}</option>' for mid, title in movie_list])}
+                    {{OPTIONS}}
                 </select>
             </div>
 
@@ -168,7 +305,7 @@ def index():
                 <label for="movie3">3つ目の映画:</label>
                 <select name="movie3" id="movie3">
                     <option value="">-- 映画を選択してください --</option>
-                    {"".join([f'<option value="{mid}">{title}</option>' for mid, title in movie_list])}
+                    {{OPTIONS}}
                 </select>
             </div>
 
@@ -180,7 +317,12 @@ def index():
     </div>
 </body>
 </html>
-"""
+""".replace("{{OPTIONS}}", OPTIONS_HTML)
+
+
+@app.route('/')
+def index():
+    return INDEX_HTML
 
 
 @app.route('/recommend', methods=['POST'])
@@ -197,7 +339,7 @@ def recommend():
         recommendations = get_recommendations(list(set(movie_ids)))
         header = f"🎬 選択された{valid_selection_count}作品に基づくオススメ映画トップ5"
     else:
-        recommendations = get_top_rated_movies()
+        recommendations = TOP_RATED_TITLES
         header = "⭐ 好きな映画が未選択のため、総合的に評価値が高い映画トップ5"
 
     recommendation_html = f"<h3>{header}</h3><ol>"
@@ -230,4 +372,7 @@ def recommend():
 
 if __name__ == '__main__':
     print("サーバーを起動します... http://127.0.0.1:5000/")
-    app.run(host='127.0.0.1', port=5000, debug=True)
\ No newline at end of file
+    # デバッグモードは環境変数 FLASK_DEBUG=1 のときだけ有効にする
+    # リローダーはファイル更新のたびにデータ読み込みからやり直すため使わない
+    debug = os.environ.get("FLASK_DEBUG") == "1"
+    app.run(host='127.0.0.1', port=5000, debug=debug, use_reloader=False, threaded=True)
\ No newline at end of file